@@ -1,13 +1,18 @@
 import os
-import requests
-import base64
 from flask import Flask, request, jsonify
 from telegram import Bot, Update
 from telegram.ext import Dispatcher, MessageHandler, Filters, CommandHandler
+from telegram.utils.request import Request
 import google.generativeai as genai
 from io import BytesIO
 from PIL import Image
+from google.api_core import exceptions as google_exceptions
 import logging
+import time
+import threading
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -15,28 +20,113 @@ app = Flask(__name__)
 # Configuration
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', 32))
 
 # Initialize clients
-bot = Bot(token=TELEGRAM_TOKEN)
+# Pool sized so every worker thread (plus the webhook) can hold a connection
+bot = Bot(token=TELEGRAM_TOKEN, request=Request(con_pool_size=WORKER_THREADS + 4))
 genai.configure(api_key=GEMINI_API_KEY)
+gemini_model = genai.GenerativeModel('gemini-2.5-flash')
+
+# Retry settings for transient Gemini errors
+GEMINI_MAX_RETRIES = 3
+GEMINI_RETRY_BASE_DELAY = 1.0
+GEMINI_RETRYABLE_ERRORS = (
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+)
+
+# Static replies
+_WELCOME_TEXT = "🌿 Plant Doctor Bot - Send me a plant photo for analysis!"
+_HELP_TEXT = """
+🌱 *Plant Doctor Bot*
+
+Send me a photo of your plant for AI analysis!
+
+Commands:
+/start - Show this message
+/analyze - Analyze a plant photo
+"""
+
+# Split long replies below Telegram's 4096-character message limit
+MESSAGE_LIMIT = 4000
+
+# Markdown characters escaped in model output, applied in one pass
+_MD_ESCAPE = str.maketrans({'*': '\\*', '_': '\\_', '[': '\\[', ']': '\\]'})
+
+# Largest side sent to the vision model; bigger photos are downscaled first.
+# Matches Telegram's standard 1280px photo size so most uploads pass through as-is.
+MAX_IMAGE_SIDE = 1280
+JPEG_QUALITY = 85
+
+# Recent analyses keyed by photo hash, so re-sent photos skip the model call
+ANALYSIS_CACHE_SIZE = 1024
+_analysis_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+# Concurrency and rate limits for Gemini calls, sized to the API tier
+# (clamped to at least 1: zero would deadlock the semaphore or divide by zero)
+GEMINI_MAX_CONCURRENCY = max(1, int(os.getenv('GEMINI_MAX_CONCURRENCY', 8)))
+GEMINI_QPM = max(1, int(os.getenv('GEMINI_QPM', 60)))
+gemini_semaphore = threading.BoundedSemaphore(GEMINI_MAX_CONCURRENCY)
+_rate_lock = threading.Lock()
+_next_call_at = 0.0
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Background workers so the webhook can ack Telegram before the slow analysis runs.
+# Once acked, Telegram never redelivers an update, so anything still queued
+# when the process stops is lost (at-most-once delivery).
+executor = ThreadPoolExecutor(max_workers=WORKER_THREADS)
+
+# Cap on queued + running updates; past this the webhook returns 503 so
+# Telegram retries later instead of the backlog growing in memory
+MAX_PENDING_UPDATES = max(1, int(os.getenv('MAX_PENDING_UPDATES', WORKER_THREADS * 4)))
+_pending_updates = threading.BoundedSemaphore(MAX_PENDING_UPDATES)
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
     """Main webhook handler for Telegram"""
     if request.method == 'POST':
         update = Update.de_json(request.get_json(), bot)
         
+        # Hand off to a worker and return immediately so Telegram doesn't retry
         if update.message:
-            handle_message(update.message)
+            accepted = submit_update(handle_message, update.message)
         elif update.callback_query:
-            handle_callback(update.callback_query)
+            accepted = submit_update(handle_callback, update.callback_query)
+        else:
+            accepted = True
+        
+        if not accepted:
+            logger.warning("Too many pending updates, asking Telegram to retry")
+            return jsonify({'status': 'busy'}), 503
             
     return jsonify({'status': 'ok'})
 
+def submit_update(handler, payload):
+    """Queue handler on a worker thread; returns False if the queue is full"""
+    if not _pending_updates.acquire(blocking=False):
+        return False
+    try:
+        future = executor.submit(handler, payload)
+    except Exception:
+        _pending_updates.release()
+        raise
+    future.add_done_callback(finish_update)
+    return True
+
+def finish_update(future):
+    """Done callback: free the pending slot and surface dropped exceptions"""
+    _pending_updates.release()
+    error = future.exception()
+    if error is not None:
+        logger.error("Unhandled error in background handler", exc_info=error)
+
 def handle_message(message):
     """Handle incoming messages"""
     chat_id = message.chat.id
@@ -58,8 +148,7 @@ def handle_text_message(message):
     if text.startswith('/'):
         handle_commands(message)
     else:
-        welcome_text = "🌿 Plant Doctor Bot - Send me a plant photo for analysis!"
-        bot.send_message(chat_id, welcome_text, parse_mode='Markdown')
+        bot.send_message(chat_id, _WELCOME_TEXT, parse_mode='Markdown')
 
 def handle_commands(message):
     """Handle bot commands"""
@@ -67,16 +156,7 @@ def handle_commands(message):
     text = message.text.strip().lower()
     
     if text == '/start' or text == '/help':
-        welcome_text = """
-🌱 *Plant Doctor Bot*
-
-Send me a photo of your plant for AI analysis!
-
-Commands:
-/start - Show this message
-/analyze - Analyze a plant photo
-"""
-        bot.send_message(chat_id, welcome_text, parse_mode='Markdown')
+        bot.send_message(chat_id, _HELP_TEXT, parse_mode='Markdown')
     
     elif text == '/analyze':
         bot.send_message(chat_id, "📸 Please send me a photo of your plant for analysis.")
@@ -86,33 +166,63 @@ def handle_plant_analysis(message):
     chat_id = message.chat.id
     
     try:
-        processing_msg = bot.send_message(chat_id, "🔍 Analyzing your plant photo...")
-        
         # Get the highest quality photo
         photo_file = message.photo[-1].get_file()
         
-        # Download photo
-        photo_bytes = BytesIO()
-        photo_file.download(out=photo_bytes)
-        photo_bytes.seek(0)
+        # Download photo into a single buffer
+        raw_bytes = photo_file.download_as_bytearray()
         
-        # Open as PIL Image
-        img = Image.open(photo_bytes)
+        # Same photo analyzed recently: reply straight away
+        cache_key = hashlib.blake2b(raw_bytes, digest_size=16).digest()
+        analysis = get_cached_analysis(cache_key)
+        if analysis is not None:
+            send_analysis_results(chat_id, analysis)
+            return
         
-        # Analyze with Gemini
-        analysis = analyze_plant_with_gemini(img)
+        processing_msg = bot.send_message(chat_id, "🔍 Analyzing your plant photo...")
+        
+        # Shrink to model resolution before upload
+        image_bytes = prepare_image(raw_bytes)
         
-        # Delete processing message
-        bot.delete_message(chat_id, processing_msg.message_id)
+        # Analyze with Gemini
+        analysis = analyze_plant_with_gemini(image_bytes)
+        cache_analysis(cache_key, analysis)
         
-        # Send results
-        send_analysis_results(chat_id, analysis)
+        # Replace the processing message with the results
+        send_analysis_results(chat_id, analysis, processing_msg.message_id)
         
     except Exception as e:
         logger.error(f"Error analyzing plant: {e}")
         bot.send_message(chat_id, f"❌ Sorry, I couldn't analyze the image. Error: {str(e)}")
 
-def analyze_plant_with_gemini(image):
+def get_cached_analysis(key):
+    """Return a cached analysis for this photo hash, or None"""
+    with _cache_lock:
+        analysis = _analysis_cache.get(key)
+        if analysis is not None:
+            _analysis_cache.move_to_end(key)
+        return analysis
+
+def cache_analysis(key, analysis):
+    """Store an analysis, evicting the least recently used entry when full"""
+    with _cache_lock:
+        _analysis_cache[key] = analysis
+        _analysis_cache.move_to_end(key)
+        if len(_analysis_cache) > ANALYSIS_CACHE_SIZE:
+            _analysis_cache.popitem(last=False)
+
+def prepare_image(raw_bytes):
+    """Downscale large photos and re-encode as JPEG; small ones pass through"""
+    img = Image.open(BytesIO(raw_bytes))
+    if max(img.size) <= MAX_IMAGE_SIDE and img.format == 'JPEG':
+        return bytes(raw_bytes)
+    
+    img.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.LANCZOS)
+    out = BytesIO()
+    img.convert('RGB').save(out, 'JPEG', quality=JPEG_QUALITY)
+    return out.getvalue()
+
+def analyze_plant_with_gemini(image_bytes):
     """Use Google Gemini to analyze plant issues"""
     
     # Check if API key is set
@@ -133,9 +243,8 @@ Be specific and practical in your advice. If you cannot identify the plant or is
 """
     
     try:
-        # Use correct model names
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content([prompt, image])
+        image_part = {'mime_type': 'image/jpeg', 'data': image_bytes}
+        response = generate_with_retry([prompt, image_part])
         
         if not response.text:
             raise Exception("Gemini returned empty response")
@@ -153,20 +262,35 @@ Be specific and practical in your advice. If you cannot identify the plant or is
         else:
             raise Exception(f"Gemini API error: {str(e)}")
 
-def send_analysis_results(chat_id, analysis):
-    """Send formatted analysis results to user"""
-    
-    # Remove the "consult local expert" line and just show the analysis
-    formatted_response = f"""
-🌿 *Plant Analysis Results*
+def wait_for_rate_limit():
+    """Space Gemini calls so we stay under GEMINI_QPM"""
+    global _next_call_at
+    with _rate_lock:
+        now = time.monotonic()
+        wait = _next_call_at - now
+        _next_call_at = max(now, _next_call_at) + 60.0 / GEMINI_QPM
+    if wait > 0:
+        time.sleep(wait)
 
-{analysis}
+def generate_with_retry(contents):
+    """Call Gemini, backing off exponentially on transient errors"""
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        try:
+            with gemini_semaphore:
+                wait_for_rate_limit()
+                return gemini_model.generate_content(contents)
+        except GEMINI_RETRYABLE_ERRORS as e:
+            if attempt == GEMINI_MAX_RETRIES:
+                raise
+            delay = GEMINI_RETRY_BASE_DELAY * (2 ** attempt)
+            logger.warning(f"Gemini transient error ({e}), retrying in {delay:.0f}s")
+            time.sleep(delay)
 
-🌱 *Need more help? Send another photo!*
-"""
+def send_analysis_results(chat_id, analysis, message_id=None):
+    """Send formatted analysis results to user, editing message_id in place if given"""
     
     # Escape markdown special characters in analysis
-    analysis_escaped = analysis.replace('*', '\\*').replace('_', '\\_').replace('[', '\\[').replace(']', '\\]')
+    analysis_escaped = analysis.translate(_MD_ESCAPE)
     formatted_response = f"""
 🌿 *Plant Analysis Results*
 
@@ -175,18 +299,46 @@ def send_analysis_results(chat_id, analysis):
 🌱 *Need more help? Send another photo!*
 """
     
-    if len(formatted_response) > 4000:
-        chunks = [formatted_response[i:i+4000] for i in range(0, len(formatted_response), 4000)]
-        for chunk in chunks:
+    for chunk in _chunk_md(formatted_response):
+        if message_id is not None:
+            # First chunk reuses the "Analyzing..." message
             try:
-                bot.send_message(chat_id, chunk, parse_mode='Markdown')
+                bot.edit_message_text(chunk, chat_id=chat_id, message_id=message_id, parse_mode='Markdown')
             except:
-                bot.send_message(chat_id, chunk)  # Send without markdown if it fails
-    else:
+                bot.edit_message_text(chunk, chat_id=chat_id, message_id=message_id)  # Edit without markdown if it fails
+            message_id = None
+            continue
         try:
-            bot.send_message(chat_id, formatted_response, parse_mode='Markdown')
+            bot.send_message(chat_id, chunk, parse_mode='Markdown')
         except:
-            bot.send_message(chat_id, formatted_response)  # Send without markdown if it fails
+            bot.send_message(chat_id, chunk)  # Send without markdown if it fails
+
+def _chunk_md(text, limit=MESSAGE_LIMIT):
+    """Yield message-sized chunks, splitting on paragraph breaks where possible.
+
+    Whitespace-only chunks are skipped: Telegram rejects them as empty messages.
+    """
+    if len(text) <= limit:
+        if text.strip():
+            yield text
+        return
+    
+    current = ''
+    for block in text.split('\n\n'):
+        candidate = f"{current}\n\n{block}" if current else block
+        if len(candidate) <= limit:
+            current = candidate
+            continue
+        if current.strip():
+            yield current
+        # A single paragraph over the limit gets a hard split
+        while len(block) > limit:
+            if block[:limit].strip():
+                yield block[:limit]
+            block = block[limit:]
+        current = block
+    if current.strip():
+        yield current
 
 def handle_callback(callback_query):
     """Handle callback queries"""
@@ -222,12 +374,12 @@ def test_gemini():
         if not GEMINI_API_KEY:
             return "❌ GEMINI_API_KEY not set"
         
-        model = genai.GenerativeModel('gemini-2.5-flash')
-        response = model.generate_content("Say 'Hello World'")
+        response = generate_with_retry("Say 'Hello World'")
         return f"✅ Gemini API working! Response: {response.text}"
     except Exception as e:
         return f"❌ Gemini API error: {str(e)}"
 
+# Local development only; production runs through wsgi.py under gunicorn
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
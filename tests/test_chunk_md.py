@@ -0,0 +1,46 @@
+import os
+
+# main builds the Telegram Bot at import, which validates the token format
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:test-token')
+
+from main import _chunk_md
+
+
+def _strip_ws(text):
+    return ''.join(text.split())
+
+
+def _check(text, limit):
+    chunks = list(_chunk_md(text, limit))
+    for chunk in chunks:
+        assert 1 <= len(chunk) <= limit
+        assert chunk.strip()
+    # Only whitespace (paragraph breaks, blank paragraphs) may be dropped
+    assert _strip_ws(''.join(chunks)) == _strip_ws(text)
+    return chunks
+
+
+def test_short_text_is_one_chunk():
+    assert _check('hello *world*', 4000) == ['hello *world*']
+
+
+def test_paragraphs_are_packed_up_to_limit():
+    text = '\n\n'.join(['a' * 10, 'b' * 10, 'c' * 10])
+    chunks = _check(text, 25)
+    assert chunks == ['a' * 10 + '\n\n' + 'b' * 10, 'c' * 10]
+
+
+def test_long_paragraph_is_hard_split():
+    text = 'x' * 5 + '\n\n' + 'y' * 25
+    chunks = _check(text, 10)
+    assert chunks == ['x' * 5, 'y' * 10, 'y' * 10, 'y' * 5]
+
+
+def test_whitespace_only_paragraphs_are_skipped():
+    text = 'a' * 3999 + '\n\n \n\n' + 'b' * 3999
+    assert _check(text, 4000) == ['a' * 3999, 'b' * 3999]
+
+
+def test_whitespace_hard_split_remainder_is_skipped():
+    text = 'a' * 10 + '   ' + '\n\n' + 'b' * 10
+    assert _check(text, 10) == ['a' * 10, 'b' * 10]
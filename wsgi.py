@@ -0,0 +1,6 @@
+"""Production entrypoint for gunicorn; see Procfile for the serve command.
+
+Runs as a single process so the analysis cache and Gemini rate limiter in
+main.py are shared by every request.
+"""
+from main import app